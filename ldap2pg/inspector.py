@@ -48,7 +48,7 @@ class PostgresInspector(object):
         if isinstance(query, list):
             return query
 
-        row_cols = ['rolname'] + RoleOptions.SUPPORTED_COLUMNS
+        row_cols = ('rolname',) + RoleOptions.SUPPORTED_COLUMNS
         row_cols = ['role.%s' % (r,) for r in row_cols]
         return query.format(options=', '.join(row_cols[1:]))
 
@@ -5,11 +5,27 @@ import logging
 
 from .format import collect_fields, AttributesMap, FormatList
 from .psql import Query
-from .utils import dedent, unicode
+from .utils import dedent, intern, unicode
 
 
 logger = logging.getLogger(__name__)
 
+CREATE_ROLE_SQL = dedent("""\
+CREATE ROLE "{role}" WITH {options};
+COMMENT ON ROLE "{role}" IS '{comment}';
+""")
+
+TERMINATE_SESSIONS_SQL = dedent("""\
+SELECT pg_terminate_backend(pid)
+FROM pg_catalog.pg_stat_activity
+WHERE usename = '%s';
+""")
+
+
+def _quote_join(names):
+    # str.join() builds a list from a generator anyway, give it a list.
+    return ", ".join(['"%s"' % name for name in names])
+
 
 class Role(object):
     __slots__ = (
@@ -24,15 +40,19 @@ class Role(object):
 
     def __init__(self, name, options=None, members=None, parents=None,
                  comment=None):
-        self.name = name
-        self.lname = name.lower()
-        self.uname = name.upper()
+        # Interned names speed up comparisons in sets and dicts.
+        self.name = intern(name)
+        self.lname = intern(name.lower())
+        self.uname = intern(name.upper())
         self.members = members or []
         self.options = RoleOptions(options or {})
         self.parents = parents or []
         self.comment = comment
 
     def __eq__(self, other):
+        if isinstance(other, Role):
+            # Fast path for set and dict lookups.
+            return self.name == other.name
         return self.name == unicode(other)
 
     def __hash__(self):
@@ -63,10 +83,7 @@ class Role(object):
         yield Query(
             'Create %s.' % (self.name,),
             None,
-            dedent("""\
-            CREATE ROLE "{role}" WITH {options};
-            COMMENT ON ROLE "{role}" IS '{comment}';
-            """).format(
+            CREATE_ROLE_SQL.format(
                 role=self.name, options=self.options,
                 comment=self.comment or '')
         )
@@ -75,7 +92,7 @@ class Role(object):
                 'Add %s members.' % (self.name,),
                 None,
                 'GRANT "%(role)s" TO %(members)s;' % dict(
-                    members=", ".join(map(lambda x: '"%s"' % x, self.members)),
+                    members=_quote_join(self.members),
                     role=self.name,
                 ),
             )
@@ -101,36 +118,45 @@ class Role(object):
                     role=other.name, options=other.options)
             )
 
-        if self.members != other.members:
-            renamed = set([
-                name for name in other.members
-                if name.lower() in self.members
-            ])
-            renamed_lower = set([name.lower() for name in renamed])
-            missing = set(other.members) - renamed - set(self.members)
+        # Identity check skips comparing items when altering a role to
+        # itself.
+        if self.members is not other.members and self.members != other.members:
+            my_members = set(self.members)
+            their_members = set(other.members)
+            renamed = set(
+                name for name in their_members
+                if name.lower() in my_members
+            )
+            renamed_lower = set(name.lower() for name in renamed)
+            missing = their_members - renamed - my_members
+            spurious = my_members - renamed_lower - their_members
+            # Send GRANT and REVOKE in a single query to save a round trip.
+            queries = []
             if missing:
                 logger.debug(
                     "Role %s miss members %s.",
                     other.name, ', '.join(missing)
                 )
-                yield Query(
-                    'Add missing %s members.' % (other.name,),
-                    None,
-                    "GRANT \"%(role)s\" TO %(members)s;" % dict(
-                        members=", ".join(map(lambda x: '"%s"' % x, missing)),
-                        role=other.name,
-                    ),
-                )
-            spurious = set(self.members) - renamed_lower - set(other.members)
+                queries.append("GRANT \"%(role)s\" TO %(members)s;" % dict(
+                    members=_quote_join(missing),
+                    role=other.name,
+                ))
             if spurious:
-                yield Query(
-                    'Delete spurious %s members.' % (other.name,),
-                    None,
-                    "REVOKE \"%(role)s\" FROM %(members)s;" % dict(
-                        members=", ".join(map(lambda x: '"%s"' % x, spurious)),
-                        role=other.name,
-                    ),
-                )
+                queries.append("REVOKE \"%(role)s\" FROM %(members)s;" % dict(
+                    members=_quote_join(spurious),
+                    role=other.name,
+                ))
+
+            if missing and spurious:
+                message = 'Synchronize %s members.'
+            elif missing:
+                message = 'Add missing %s members.'
+            elif spurious:
+                message = 'Delete spurious %s members.'
+            else:
+                message = None
+            if message:
+                yield Query(message % (other.name,), None, '\n'.join(queries))
 
         if self.comment != other.comment:
             yield Query(
@@ -145,11 +171,7 @@ class Role(object):
     def drop(self, databases=None, me=None):
         yield Query(
             'Terminate running sessions for %s.' % self.name,
-            None, dedent("""\
-            SELECT pg_terminate_backend(pid)
-            FROM pg_catalog.pg_stat_activity
-            WHERE usename = '%s';
-            """) % self.name,
+            None, TERMINATE_SESSIONS_SQL % self.name,
         )
         databases = databases or []
         for db in databases:
@@ -188,7 +210,7 @@ class Role(object):
     def rename_members(self, renamed):
         # renamed: oldname -> newrole.
         # Apply renaming to members.
-        for i, oldname in enumerate(self.members[:]):
+        for i, oldname in enumerate(self.members):
             try:
                 oldname = renamed[oldname].name
             except KeyError:
@@ -197,7 +219,7 @@ class Role(object):
                 self.members[i] = oldname
 
 
-class RoleOptions(dict):
+class RoleOptions(object):
     COLUMNS = OrderedDict([
         # column: (option, default)
         ('rolbypassrls', ('BYPASSRLS', False)),
@@ -209,8 +231,15 @@ class RoleOptions(dict):
         ('rolsuper', ('SUPERUSER', False)),
     ])
 
-    SUPERONLY_COLUMNS = ['rolsuper', 'rolreplication', 'rolbypassrls']
-    SUPPORTED_COLUMNS = list(COLUMNS.keys())
+    # Options are stored as slots rather than in a dict, in COLUMNS order.
+    # Mapping methods are kept for compatibility.
+    __slots__ = tuple(o for o, _ in COLUMNS.values())
+
+    SUPERONLY_COLUMNS = ('rolsuper', 'rolreplication', 'rolbypassrls')
+    SUPPORTED_COLUMNS = tuple(COLUMNS)
+
+    _VALUE_DEFAULTS = dict((o, d) for c, (o, d) in COLUMNS.items())
+    _FIXED_KEYS = frozenset(__slots__)
 
     @classmethod
     def supported_options(cls):
@@ -219,6 +248,13 @@ class RoleOptions(dict):
             if c in cls.SUPPORTED_COLUMNS
         ]
 
+    @classmethod
+    def _refresh_supported_options(cls):
+        # Cache supported options for parsing rows and formatting SQL. Must be
+        # called each time SUPPORTED_COLUMNS changes.
+        cls._SUPPORTED_OPTION_NAMES = tuple(cls.supported_options())
+        cls.SUPPORTED_OPTIONS = frozenset(cls._SUPPORTED_OPTION_NAMES)
+
     COLUMNS_QUERY = dedent("""
     SELECT array_agg(attrs.attname)
     FROM pg_catalog.pg_namespace AS nsp
@@ -232,10 +268,11 @@ class RoleOptions(dict):
 
     @classmethod
     def update_supported_columns(cls, columns):
-        cls.SUPPORTED_COLUMNS = [
+        cls.SUPPORTED_COLUMNS = tuple(
             c for c in cls.SUPPORTED_COLUMNS
             if c in columns
-        ]
+        )
+        cls._refresh_supported_options()
         logger.debug(
             "Postgres server supports role options %s.",
             ", ".join(cls.supported_options()),
@@ -243,58 +280,156 @@ class RoleOptions(dict):
 
     @classmethod
     def filter_super_columns(cls):
-        cls.SUPPORTED_COLUMNS = [
+        cls.SUPPORTED_COLUMNS = tuple(
             c for c in cls.SUPPORTED_COLUMNS
             if c not in cls.SUPERONLY_COLUMNS
-        ]
+        )
+        cls._refresh_supported_options()
 
     def __init__(self, *a, **kw):
-        defaults = dict([(o, None) for c, (o, d) in self.COLUMNS.items()])
-        super(RoleOptions, self).__init__(**defaults)
+        for name in self.__slots__:
+            setattr(self, name, None)
         init = dict(*a, **kw)
         self.update(init)
 
+    def __contains__(self, key):
+        return key in self._FIXED_KEYS
+
+    def __eq__(self, other):
+        if isinstance(other, RoleOptions):
+            for name in self.__slots__:
+                if getattr(self, name) != getattr(other, name):
+                    return False
+            return True
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    # Options are mutable.
+    __hash__ = None
+
+    def __getitem__(self, key):
+        if key not in self._FIXED_KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
     def __repr__(self):
         return '<%s %s>' % (self.__class__.__name__, self)
 
+    def __setitem__(self, key, value):
+        if key not in self._FIXED_KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
     def __str__(self):
         return ' '.join((
             ('NO' if value is False else '') + name
             for name, value in self.items()
-            if name in self.supported_options()
+            if name in self.SUPPORTED_OPTIONS
         ))
 
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.__slots__]
+
+    def keys(self):
+        return list(self.__slots__)
+
     def update_from_row(self, row):
-        self.update(dict(zip(self.supported_options(), row)))
+        for name, value in zip(self._SUPPORTED_OPTION_NAMES, row):
+            setattr(self, name, value)
 
     def update(self, other):
-        spurious_options = set(other.keys()) - set(self.keys())
+        spurious_options = [k for k in other if k not in self._FIXED_KEYS]
         if spurious_options:
             message = "Unknown options %s" % (', '.join(spurious_options),)
             raise ValueError(message)
 
         for k, their in other.items():
-            my = self[k]
+            my = getattr(self, k)
             if their is None:
                 continue
             if my is None:
-                self[k] = their
+                setattr(self, k, their)
             elif my != their:
                 raise ValueError("Two values defined for option %s." % k)
 
     def fill_with_defaults(self):
-        defaults = dict([(o, d) for c, (o, d) in self.COLUMNS.items()])
-        for k, v in self.items():
-            if v is None:
-                self[k] = defaults[k]
+        for k in self.__slots__:
+            if getattr(self, k) is None:
+                setattr(self, k, self._VALUE_DEFAULTS[k])
+
+
+RoleOptions._refresh_supported_options()
 
 
 class RoleSet(set):
+    # Lazy cache of name -> role, reset by each mutation of the set.
+    _index = None
+
+    def add(self, role):
+        self._index = None
+        return super(RoleSet, self).add(role)
+
+    def clear(self):
+        self._index = None
+        return super(RoleSet, self).clear()
+
+    def difference_update(self, *others):
+        self._index = None
+        return super(RoleSet, self).difference_update(*others)
+
+    def discard(self, role):
+        self._index = None
+        return super(RoleSet, self).discard(role)
+
+    def intersection_update(self, *others):
+        self._index = None
+        return super(RoleSet, self).intersection_update(*others)
+
+    def pop(self):
+        self._index = None
+        return super(RoleSet, self).pop()
+
+    def remove(self, role):
+        self._index = None
+        return super(RoleSet, self).remove(role)
+
+    def symmetric_difference_update(self, other):
+        self._index = None
+        return super(RoleSet, self).symmetric_difference_update(other)
+
+    def update(self, *others):
+        self._index = None
+        return super(RoleSet, self).update(*others)
+
+    def __iand__(self, other):
+        self._index = None
+        return super(RoleSet, self).__iand__(other)
+
+    def __ior__(self, other):
+        self._index = None
+        return super(RoleSet, self).__ior__(other)
+
+    def __isub__(self, other):
+        self._index = None
+        return super(RoleSet, self).__isub__(other)
+
+    def __ixor__(self, other):
+        self._index = None
+        return super(RoleSet, self).__ixor__(other)
+
     def resolve_membership(self):
         index_ = self.reindex()
         for role in self:
             # Synchronize role.parents -> parent.members
-            for parent_name in role.parents[:]:
+            for parent_name in role.parents:
                 try:
                     parent = index_[parent_name]
                 except KeyError:
@@ -304,7 +439,7 @@ class RoleSet(set):
                 parent.members.append(role.name)
 
             # Synchronize role.members -> member.parents
-            for member_name in role.members[:]:
+            for member_name in role.members:
                 try:
                     member = index_[member_name]
                 except KeyError:
@@ -314,7 +449,11 @@ class RoleSet(set):
                 member.parents.append(role.name)
 
     def reindex(self):
-        return dict([(role.name, role) for role in self])
+        # Returns name -> role dict. The dict is cached until next mutation of
+        # the set, don't modify it.
+        if self._index is None:
+            self._index = dict((role.name, role) for role in self)
+        return self._index
 
     def flatten(self):
         # Generates the flatten tree of roles, children first.
@@ -322,29 +461,51 @@ class RoleSet(set):
         index = self.reindex()
         seen = set()
 
-        def walk(name):
+        for name in sorted(index):
             if name in seen:
-                return
-            try:
-                role = index[name]
-            except KeyError:
-                # We are trying to walk a member out of set. This is the case
-                # where a role is missing but not one of its member.
-                return
-
-            for member in role.members:
-                for i in walk(member):
-                    yield i
-            yield name
+                continue
             seen.add(name)
-
-        for name in sorted(index.keys()):
-            for i in walk(name):
-                yield index[i]
+            # Iterative depth-first walk. Each stack item holds a role and the
+            # iterator on its remaining members.
+            stack = [(index[name], iter(index[name].members))]
+            while stack:
+                role, members = stack[-1]
+                for member in members:
+                    if member in seen:
+                        continue
+                    if member not in index:
+                        # We are trying to walk a member out of set. This is
+                        # the case where a role is missing but not one of its
+                        # member.
+                        continue
+                    seen.add(member)
+                    stack.append((index[member], iter(index[member].members)))
+                    break
+                else:
+                    # All members yielded, now yield role.
+                    stack.pop()
+                    yield role
 
     def union(self, other):
         return self.__class__(self | other)
 
+    def _is_synchronized(self, other, index, other_index):
+        # Tells whether diff yields no query, without computing it. Bails out
+        # on first difference.
+        if not other <= self:
+            # Either missing or unmanaged roles.
+            return False
+        if self - other - set(['public']):
+            # Spurious roles.
+            return False
+        for name, its in other_index.items():
+            mine = index.get(name)
+            if mine is None:
+                return False
+            for _ in mine.alter(its):
+                return False
+        return True
+
     def diff(
             self, other=None, available=None, fallback_owner=None,
             databases=None, me=None):
@@ -355,59 +516,86 @@ class RoleSet(set):
         # Available is a superset of self. Use the same index for self.
         index = available.reindex()
         other = other or RoleSet()
+        other_index = other.reindex()
+
+        if self._is_synchronized(other, index, other_index):
+            # Periodic runs usually have nothing to do. Skip the full diff.
+            return
 
         # First create/rename missing roles
         missing = RoleSet(other - available)
         missing_index = missing.reindex()
 
+        # Index available roles by case folded names, to search renames from
+        # mixed case to upper/lower case.
+        lindex = dict()
+        uindex = dict()
+        for role in available:
+            lindex.setdefault(role.lname, []).append(role)
+            uindex.setdefault(role.uname, []).append(role)
+
         # newname -> oldrole
         renames = dict()
 
-        # Search renames from upper/lower case to mixed case.
         for newrole in missing:
-            loldrole = index.get(newrole.lname)
-            uoldrole = index.get(newrole.uname)
-            if loldrole and uoldrole:
-                logger.debug(
-                    "Can't choose renaming %s from %s or %s. Creating.",
-                    newrole.name, loldrole.name, uoldrole.name)
-                continue
-            oldrole = loldrole or uoldrole
-            if not oldrole:
-                continue
-
-            if oldrole in other:
-                logger.debug(
-                    "Wants both existing %s and new %s. Creating",
-                    oldrole.name, newrole.name)
+            if newrole.lname == newrole.uname:
+                # Name has no case.
                 continue
-            renames[newrole.name] = oldrole
+            elif newrole.name not in (newrole.lname, newrole.uname):
+                # Search renames from upper/lower case to mixed case. Index is
+                # by exact name: we search an existing role named as the lower
+                # or upper case of the new name.
+                loldrole = index.get(newrole.lname)
+                uoldrole = index.get(newrole.uname)
+                if loldrole and uoldrole:
+                    logger.debug(
+                        "Can't choose renaming %s from %s or %s. Creating.",
+                        newrole.name, loldrole.name, uoldrole.name)
+                    continue
+                oldroles = [r for r in (loldrole, uoldrole) if r]
+                twin = None
+            else:
+                # Search renames from any case to upper/lower case.
+                if newrole.name == newrole.lname:
+                    twin, folded_index = newrole.uname, lindex
+                else:
+                    twin, folded_index = newrole.lname, uindex
+                oldroles = folded_index.get(newrole.name, [])
+                if oldroles and twin in missing_index:
+                    logger.debug(
+                        "Can't choose renaming %s to %s or %s. Dropping.",
+                        ', '.join(r.name for r in oldroles),
+                        newrole.name, twin)
+                    continue
 
-        # Search renames from mixed case to upper/lower case.
-        for oldrole in available:
-            lnewrole = missing_index.get(oldrole.lname)
-            unewrole = missing_index.get(oldrole.uname)
-            if lnewrole and unewrole:
-                logger.debug(
-                    "Can't choose renaming %s to %s or %s. Dropping.",
-                    oldrole.name, lnewrole.name, unewrole.name)
-                continue
-            newrole = lnewrole or unewrole
-            if not newrole:
-                continue
-            if oldrole in other:
+            reusable = []
+            for oldrole in oldroles:
+                if oldrole.name in other_index:
+                    logger.debug(
+                        "Wants both existing %s and new %s. Creating.",
+                        oldrole.name, newrole.name)
+                else:
+                    reusable.append(oldrole)
+
+            if len(reusable) > 1:
+                # Prefer the role named as the other case of the new name,
+                # over mixed case roles.
+                exact = index.get(twin)
+                reusable = [r for r in reusable if r is exact] or reusable
+
+            if len(reusable) > 1:
                 logger.debug(
-                    "Wants both existing %s and new %s. Creating.",
-                    oldrole.name, newrole.name)
-                continue
-            renames[newrole.name] = oldrole
+                    "Can't choose renaming %s from %s. Creating.",
+                    newrole.name, ', '.join(r.name for r in reusable))
+            elif reusable:
+                renames[newrole.name] = reusable[0]
 
         # Index renames by oldname
         # oldname -> newrole
-        renamed = dict([
+        renamed = dict(
             (oldrole.name, missing_index[newname])
             for newname, oldrole in renames.items()
-        ])
+        )
 
         # Create missing first, in order.
         for role in missing.flatten():
@@ -427,20 +615,12 @@ class RoleSet(set):
             for qry in oldrole.rename(newrole):
                 yield qry
             # Update role inspection result to match rename.
-            available.remove(oldrole)
-            managed = oldrole in self
-            if managed:
-                self.remove(oldrole)
-            oldrole.name = newrole.name
-            available.add(oldrole)
-            if managed:
-                self.add(oldrole)
+            _rename_in_place(oldrole, newrole.name, available, self)
 
         index = available.reindex()
 
         # Now update kept roles options and memberships, including renamed.
         kept = available & other
-        other_index = other.reindex()
         for role in kept:
             mine = index[role.name]
             # Rename back member to new role name, keeping objects synchronized
@@ -468,6 +648,17 @@ class RoleSet(set):
                 yield qry
 
 
+def _rename_in_place(role, name, *sets):
+    # Rename role, keeping it in sets. Role hash changes with name, so role
+    # must be removed from sets before renaming and added back after.
+    containing = [set_ for set_ in sets if role in set_]
+    for set_ in containing:
+        set_.remove(role)
+    role.name = intern(name)
+    for set_ in containing:
+        set_.add(role)
+
+
 class RoleRule(object):
     def __init__(self, names, parents=None, members=None, options=None,
                  comment=None):
@@ -481,6 +672,16 @@ class RoleRule(object):
         self.all_fields = collect_fields(
             self.comment, self.members, self.names, self.parents,
         )
+        if self.is_dynamic:
+            self._static_values = None
+        else:
+            # A static rule generates the same values for each entry. Expand
+            # them once.
+            self._static_values = tuple(
+                list(list_.expand({}))
+                for list_ in (
+                    self.names, self.comment, self.members, self.parents)
+            )
 
     def __eq__(self, other):
         return hasattr(other, 'as_dict') and self.as_dict() == other.as_dict()
@@ -504,13 +705,37 @@ class RoleRule(object):
         return self.__class__(**kw)
 
     def generate(self, vars_):
-        names = self.names.expand(vars_)
-        comments = comment_repeater(self.comment.expand(vars_))
-        members = list(self.members.expand(vars_))
-        parents = list(self.parents.expand(vars_))
+        if self._static_values:
+            names, comments, members, parents = self._static_values
+        else:
+            names = self.names.expand(vars_)
+            comments = list(self.comment.expand(vars_))
+            members = list(self.members.expand(vars_))
+            parents = list(self.parents.expand(vars_))
+
+        # Policy on comment.
+        #
+        # There is two cases where comment format yields a single value :
+        # static comment and comment from a single LDAP value (e.g. cn). To
+        # handle this, a single value is repeated for all names.
+        #
+        # Otherwise, each name consumes its own comment. There is two cases
+        # that leads to inconsistent role generation: no comment at all, or
+        # comment exhausted. A third case exists: there is more comments than
+        # role names.
+        repeated = 1 == len(comments)
 
         i = None
-        for (i, name), (comment, repeated) in zip(enumerate(names), comments):
+        for i, name in enumerate(names):
+            if repeated:
+                comment = comments[0]
+            elif i < len(comments):
+                comment = comments[i]
+            elif comments:
+                raise CommentError("Can't generate more comment.")
+            else:
+                raise CommentError("Can't generate a comment.")
+
             yield Role(
                 name=name,
                 members=members[:],
@@ -523,11 +748,7 @@ class RoleRule(object):
         if i is None or repeated:
             return
 
-        try:
-            next(comments)
-        except CommentError:  # All comments consumed.
-            pass
-        else:
+        if i + 1 < len(comments):
             raise CommentError("We have more comments than names!")
 
     def as_dict(self):
@@ -542,43 +763,3 @@ class RoleRule(object):
 
 class CommentError(Exception):
     pass
-
-
-def comment_repeater(comments):
-    # This generator handle the policy on comment.
-    #
-    # There is two cases where comment format yields a single value : static
-    # comment and comment from a single LDAP value (e.g. cn). To handle this,
-    # the generator repeats a single value forever.
-    #
-    # There is two cases that leads to inconsistent role generation: no comment
-    # at all, or comment exhausted. This generator raises NoMoreComment
-    # exception for this.
-    #
-    # A third case exists: there is more comments than role names. To handle
-    # this, the generator yields two values: new comment and a boolean whether
-    # comment is repeated.
-
-    repeated = True
-
-    try:
-        value = next(comments)
-    except StopIteration:
-        raise CommentError("Can't generate a comment.")
-    next_value = None
-
-    while True:
-        try:
-            next_value = next(comments)
-            repeated = False
-        except StopIteration:
-            if repeated:
-                next_value = value
-            else:
-                break
-        yield value, repeated
-        value = next_value
-
-    yield value, repeated
-
-    raise CommentError("Can't generate more comment.")
@@ -12,10 +12,15 @@ if PY2:  # pragma: nocover_py3
     string_types = (str, unicode)  # noqa
     unicode = unicode  # noqa
     bytes = str
+
+    def intern(string):
+        # Python 2 can't intern unicode strings.
+        return string
 else:  # pragma: nocover_py2
     string_types = (str,)
     unicode = str
     bytes = bytes  # noqa
+    intern = sys.intern
 
 try:  # pragma: nocover_py2
     from urllib.parse import urlparse, urlunparse
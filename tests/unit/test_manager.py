@@ -560,9 +560,11 @@ def test_sync(mocker):
     from ldap2pg.inspector import Database, Schema
 
     mod = 'ldap2pg.manager'
-    mocker.patch(
-        mod + '.RoleOptions.SUPPORTED_COLUMNS',
-        RoleOptions.SUPPORTED_COLUMNS[:],
+    mocker.patch.multiple(
+        mod + '.RoleOptions',
+        SUPPORTED_COLUMNS=RoleOptions.SUPPORTED_COLUMNS[:],
+        SUPPORTED_OPTIONS=RoleOptions.SUPPORTED_OPTIONS,
+        _SUPPORTED_OPTION_NAMES=RoleOptions._SUPPORTED_OPTION_NAMES,
     )
 
     cls = mod + '.SyncManager'
@@ -50,8 +50,24 @@ def test_alter():
     queries = [q.args[0] for q in a.alter(b)]
 
     assert fnfilter(queries, 'ALTER ROLE "toto" *;')
-    assert fnfilter(queries, 'GRANT "toto" TO "tata";')
-    assert fnfilter(queries, 'REVOKE "toto" FROM "titi";')
+    assert fnfilter(
+        queries, 'GRANT "toto" TO "tata";\nREVOKE "toto" FROM "titi";')
+
+    # Member renamed from lower case is neither granted nor revoked.
+    a = Role(name='toto', members=['alice', 'bob'])
+    b = Role(name='toto', members=['Alice', 'carol'])
+
+    queries = [q.args[0] for q in a.alter(b)]
+
+    assert ['GRANT "toto" TO "carol";\nREVOKE "toto" FROM "bob";'] == queries
+
+    # Only missing members.
+    b = Role(name='toto', members=['alice', 'bob', 'carol'])
+    queries = list(a.alter(b))
+
+    assert 1 == len(queries)
+    assert 'Add missing toto members.' == queries[0].message
+    assert 'GRANT "toto" TO "carol";' == queries[0].args[0]
 
 
 def test_drop():
@@ -142,6 +158,49 @@ def test_options():
     with pytest.raises(ValueError):
         RoleOptions(POUET=True)
 
+    # Defaults are not shared between instances.
+    options = RoleOptions(LOGIN=True)
+    assert RoleOptions()['LOGIN'] is None
+
+    # Options behave like a dict.
+    assert 'LOGIN' in options
+    assert 'POUET' not in options
+    assert 7 == len(options)
+    assert options == RoleOptions(options)
+    assert options == dict(options)
+    assert options != RoleOptions()
+    assert ('LOGIN', True) in options.items()
+    with pytest.raises(KeyError):
+        options['POUET']
+    with pytest.raises(KeyError):
+        options['POUET'] = True
+
+
+def test_options_supported(mocker):
+    from ldap2pg.role import RoleOptions
+
+    mocker.patch.multiple(
+        'ldap2pg.role.RoleOptions',
+        SUPPORTED_COLUMNS=RoleOptions.SUPPORTED_COLUMNS[:],
+        SUPPORTED_OPTIONS=RoleOptions.SUPPORTED_OPTIONS,
+        _SUPPORTED_OPTION_NAMES=RoleOptions._SUPPORTED_OPTION_NAMES,
+    )
+
+    assert 'SUPERUSER' in RoleOptions.SUPPORTED_OPTIONS
+
+    RoleOptions.filter_super_columns()
+
+    assert 'SUPERUSER' not in RoleOptions.SUPPORTED_OPTIONS
+    options = RoleOptions()
+    options.fill_with_defaults()
+    assert 'SUPERUSER' not in str(options)
+    assert 'NOLOGIN' in str(options)
+
+    options = RoleOptions()
+    options.update_from_row([True] * len(RoleOptions.SUPPORTED_COLUMNS))
+    assert options['SUPERUSER'] is None
+    assert options['LOGIN'] is True
+
 
 def test_flatten():
     from ldap2pg.role import RoleSet, Role
@@ -177,6 +236,14 @@ def test_flatten():
 
     assert wanted == order
 
+    # A membership loop doesn't walk forever.
+    roles = RoleSet([
+        Role('loop0', members=['loop1']),
+        Role('loop1', members=['loop0']),
+    ])
+
+    assert ['loop1', 'loop0'] == list(roles.flatten())
+
 
 def test_resolve_membership():
     from ldap2pg.role import RoleSet, Role
@@ -198,6 +265,41 @@ def test_resolve_membership():
         roles.resolve_membership()
 
 
+def test_reindex():
+    from ldap2pg.role import RoleSet, Role
+
+    roles = RoleSet([Role('alice')])
+    index = roles.reindex()
+
+    assert ['alice'] == list(index)
+    assert index is roles.reindex()
+
+    roles.add(Role('bob'))
+    assert ['alice', 'bob'] == sorted(roles.reindex())
+
+    roles -= {Role('alice')}
+    assert ['bob'] == list(roles.reindex())
+
+    roles.discard(Role('bob'))
+    assert {} == roles.reindex()
+
+    roles.update([Role('alice'), Role('bob')])
+    assert ['alice', 'bob'] == sorted(roles.reindex())
+
+    roles |= {Role('carol')}
+    assert ['alice', 'bob', 'carol'] == sorted(roles.reindex())
+
+    roles.remove(Role('alice'))
+    assert ['bob', 'carol'] == sorted(roles.reindex())
+
+    popped = roles.pop()
+    assert popped.name not in roles.reindex()
+    assert 1 == len(roles.reindex())
+
+    roles.clear()
+    assert {} == roles.reindex()
+
+
 def test_diff():
     from ldap2pg.role import Role, RoleSet
 
@@ -232,6 +334,67 @@ def test_diff():
     assert not fnfilter(queries, '*public*')
 
 
+def test_diff_synchronized(mocker):
+    from ldap2pg.role import Role, RoleSet
+
+    flatten = mocker.spy(RoleSet, 'flatten')
+
+    pgmanagedroles = RoleSet([
+        Role('alice', members=['bob'], comment='Managed'),
+        Role('bob', comment='Managed'),
+        Role('public'),
+    ])
+    pgallroles = pgmanagedroles.union({Role('dont-touch-me')})
+    ldaproles = RoleSet([
+        Role('alice', members=['bob'], comment='Managed'),
+        Role('bob', comment='Managed'),
+    ])
+
+    assert [] == list(pgmanagedroles.diff(ldaproles, pgallroles))
+    assert not flatten.called
+
+    ldaproles = RoleSet([
+        Role('alice', comment='Managed'),
+        Role('bob', comment='Managed'),
+    ])
+
+    queries = [
+        q.args[0]
+        for q in pgmanagedroles.diff(ldaproles, pgallroles)
+    ]
+
+    assert fnfilter(queries, 'REVOKE "alice" FROM "bob";')
+
+    # Role removed from LDAP is dropped.
+    flatten.reset_mock()
+    ldaproles = RoleSet([
+        Role('alice', members=['bob'], comment='Managed'),
+    ])
+
+    queries = [
+        q.args[0]
+        for q in pgmanagedroles.diff(ldaproles, pgallroles)
+    ]
+
+    assert flatten.called
+    assert fnfilter(queries, 'DROP ROLE "bob";')
+
+    # Managed role missing from available roles, like public added by
+    # filter_roles.
+    flatten.reset_mock()
+    pgallroles = RoleSet([
+        r for r in pgmanagedroles if r.name != 'public'])
+    ldaproles = RoleSet([
+        Role('alice', members=['bob'], comment='Managed'),
+        Role('bob', comment='Managed'),
+        Role('public'),
+    ])
+
+    list(pgmanagedroles.diff(ldaproles, pgallroles))
+
+    assert flatten.called
+
+
 def test_diff_rename():
     from ldap2pg.role import Role, RoleSet
 
@@ -247,6 +410,8 @@ def test_diff_rename():
         Role('MAJ2MIN'),
         Role('MAJ2MIX'),
         Role('MAJ2MAJ'),
+        Role('Twin2Min'),
+        Role('TWIN2MIN'),
     })
     ldaproles = RoleSet([
         Role('min2min'),
@@ -258,12 +423,16 @@ def test_diff_rename():
         Role('maj2min'),
         Role('Maj2Mix'),
         Role('MAJ2MAJ'),
+        Role('twin2min'),
     ])
     queries = [
         q.args[0]
         for q in pgmanagedroles.diff(ldaproles, pgallroles)
     ]
 
+    # Exact other case is preferred over mixed case.
+    assert fnfilter(queries, '*"TWIN2MIN" RENAME TO "twin2min";')
+    assert not fnfilter(queries, '*"Twin2Min" RENAME TO *')
     assert fnfilter(queries, '*"MAJ2MIX" RENAME TO "Maj2Mix";')
     assert fnfilter(queries, '*"MAJ2MIN" RENAME TO "maj2min";')
     assert fnfilter(queries, '*"min2mix" RENAME TO "Min2Mix";')
@@ -308,6 +477,8 @@ def test_diff_not_rename():
         Role('Ambigue_To'),
         Role('bothmin'),
         Role('BothMix'),
+        Role('Ambigue_Mix'),
+        Role('aMBIGUE_MIX'),
     })
     ldaproles = RoleSet([
         Role('Ambigue_From'),
@@ -317,6 +488,7 @@ def test_diff_not_rename():
         Role('Bothmin'),
         Role('BothMix'),
         Role('bothmix'),
+        Role('ambigue_mix'),
     ])
     queries = [
         q.args[0]
@@ -327,6 +499,7 @@ def test_diff_not_rename():
     assert fnfilter(queries, '*CREATE ROLE "Ambigue_From"*')
     assert fnfilter(queries, '*CREATE ROLE "ambigue_to"*')
     assert fnfilter(queries, '*CREATE ROLE "AMBIGUE_TO"*')
+    assert fnfilter(queries, '*CREATE ROLE "ambigue_mix"*')
 
 
 def test_rule():
@@ -378,6 +551,27 @@ def test_rule():
     assert 4 == len(roles)
 
 
+def test_rule_static():
+    from ldap2pg.role import RoleRule
+
+    r = RoleRule(
+        names=['alice', 'bob'],
+        members=['carol'],
+        comment='Static',
+    )
+
+    assert not r.is_dynamic
+
+    roles = list(r.generate(dict()))
+    assert ['alice', 'bob'] == [role.name for role in roles]
+    assert ['Static', 'Static'] == [role.comment for role in roles]
+
+    # Generated roles don't share members.
+    roles[0].members.append('dave')
+    roles = list(r.generate(dict()))
+    assert [['carol'], ['carol']] == [role.members for role in roles]
+
+
 def test_role_rule_dynamic_comments():
     from ldap2pg.role import RoleRule
 
@@ -433,6 +627,15 @@ def test_role_rule_no_comment():
     with pytest.raises(CommentError):
         list(r.generate(vars_))
 
+    # No names, no comment needed.
+    vars_ = dict(__self__=[dict(
+        dn=['cn=group,ou=groups'],
+        desc=[],
+        member=[],
+    )])
+
+    assert [] == list(r.generate(vars_))
+
 
 def test_role_rule_not_enough_comment():
     from ldap2pg.role import RoleRule, CommentError